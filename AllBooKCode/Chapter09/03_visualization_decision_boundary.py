@@ -5,32 +5,35 @@ from sklearn.linear_model import LogisticRegression
 from sklearn.datasets import make_blobs
 
 
-def decision_boundary():
+def decision_boundary(resolution=150):
     # 构造数据
     X, y = make_blobs(n_samples=80, centers=2, cluster_std=1.2, random_state=6)
     xlim = [np.min(X[:, 0]), np.max(X[:, 0])]
     ylim = [np.min(X[:, 1]), np.max(X[:, 1])]
     # create grid to evaluate model
-    xx = np.linspace(xlim[0], xlim[1], 500)
-    yy = np.linspace(ylim[0], ylim[1], 500)
+    # 只需画出几条等高线，150x150的网格已足够平滑，计算量约为500x500网格的1/11
+    xx = np.linspace(xlim[0], xlim[1], resolution)
+    yy = np.linspace(ylim[0], ylim[1], resolution)
     YY, XX = np.meshgrid(yy, xx)
-    xy = np.vstack([XX.ravel(), YY.ravel()]).T
+    xy = np.column_stack([XX.ravel(), YY.ravel()])  # 按行连续存放，两个模型共用
 
-    data = []
-    for i in range(len(X)):
-        index = np.where(y == i)[0]
-        data.append(X[index, :])
+    # 先训练好两个模型，再连续地在同一个网格上计算决策函数值
+    lr = LogisticRegression()
+    lr.fit(X, y)
+    svc = svm.SVC(kernel='linear', C=1000)
+    svc.fit(X, y)
+    Z1 = lr.decision_function(xy).reshape(XX.shape)
+    Z4 = svc.decision_function(xy).reshape(XX.shape)
+
+    mask = y == 0  # 两个类别的样本分别用不同的标记画出
 
     plt.figure(figsize=(8, 4), dpi=80)
     plt.rcParams['ytick.direction'] = 'in'  # 刻度向内
     plt.rcParams['xtick.direction'] = 'in'  # 刻度向内
     plt.subplot(1, 2, 1)
     # plt.scatter(X[:, 0], X[:, 1], c=y, s=40, cmap=plt.cm.Paired)
-    plt.scatter(data[0][:, 0], data[0][:, 1], marker='o', s=40, cmap=plt.cm.Paired)
-    plt.scatter(data[1][:, 0], data[1][:, 1], marker='s', s=40, cmap=plt.cm.Paired)
-    clf = LogisticRegression()
-    clf.fit(X, y)
-    Z1 = clf.decision_function(xy).reshape(XX.shape)
+    plt.scatter(X[mask, 0], X[mask, 1], marker='o', s=40, cmap=plt.cm.Paired)
+    plt.scatter(X[~mask, 0], X[~mask, 1], marker='s', s=40, cmap=plt.cm.Paired)
     plt.contour(XX, YY, Z1, colors='black', levels=[-2.2, 0, 1.8], alpha=0.8, linestyles=['--', '-', '--'])
     plt.xlabel('(a)', fontsize=15)
 
@@ -38,16 +41,13 @@ def decision_boundary():
     plt.rcParams['ytick.direction'] = 'in'  # 刻度向内
     plt.rcParams['xtick.direction'] = 'in'  # 刻度向内
     # plt.scatter(X[:, 0], X[:, 1], c=y, s=40, cmap=plt.cm.Paired)
-    plt.scatter(data[0][:, 0], data[0][:, 1], marker='o', s=40, cmap=plt.cm.Paired)
-    plt.scatter(data[1][:, 0], data[1][:, 1], marker='s', s=40, cmap=plt.cm.Paired)
-    clf = svm.SVC(kernel='linear', C=1000)
-    clf.fit(X, y)
-    Z4 = clf.decision_function(xy).reshape(XX.shape)
+    plt.scatter(X[mask, 0], X[mask, 1], marker='o', s=40, cmap=plt.cm.Paired)
+    plt.scatter(X[~mask, 0], X[~mask, 1], marker='s', s=40, cmap=plt.cm.Paired)
     plt.contour(XX, YY, Z4, colors='black', levels=[-1, 0, 1], alpha=0.8, linestyles=['--', '-', '--'])
     plt.xlabel('(d)', fontsize=15)
 
     # plot support vectors
-    plt.scatter(clf.support_vectors_[:, 0], clf.support_vectors_[:, 1], s=130,
+    plt.scatter(svc.support_vectors_[:, 0], svc.support_vectors_[:, 1], s=130,
                 linewidth=1, facecolors='none', edgecolors='k')
     plt.tight_layout()
     plt.show()
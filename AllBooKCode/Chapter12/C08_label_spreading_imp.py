@@ -1,43 +1,188 @@
 import logging
 from copy import deepcopy
-from scipy.sparse import csgraph
+from scipy.linalg import solve
+from scipy.linalg.blas import get_blas_funcs
+from scipy.sparse import coo_matrix, identity
+from scipy.sparse.linalg import splu
 from sklearn.metrics import accuracy_score
-from sklearn.metrics.pairwise import euclidean_distances
+from sklearn.neighbors import NearestNeighbors
 import numpy as np
 from C07_label_spreading_comp import load_data
 
 
-def kernel(X, y=None, gamma=None):
+def kernel(X, y=None, gamma=None, X_norm_squared=None, y_norm_squared=None, dtype=None):
+    # X_norm_squared和y_norm_squared为预先计算好的各样本的平方范数，传入时可直接复用
+    # dtype不为None时按该精度计算，例如np.float32可使内存占用和访存量减半
+    X = np.asarray(X, dtype=dtype)
+    if y is not None:
+        y = np.asarray(y, dtype=dtype)
     if gamma is None:
         gamma = 1.0 / X.shape[1]
-    K = euclidean_distances(X, y, squared=True)
+    # ||x-y||^2 = ||x||^2 + ||y||^2 - 2x^Ty，只需一次矩阵乘法
+    if X_norm_squared is None:
+        X_norm_squared = np.einsum('ij,ij->i', X, X)
+    if y is None:
+        return symmetric_kernel(X, gamma, X_norm_squared)
+    K = np.matmul(X, y.T, dtype=np.result_type(X.dtype, y.dtype, np.float32))  # 整数输入时也得到浮点结果
+    if y_norm_squared is None:
+        y_norm_squared = np.einsum('ij,ij->i', y, y)
+    K *= -2
+    K += X_norm_squared[:, None]
+    K += y_norm_squared[None, :]
+    np.maximum(K, 0, out=K)  # 舍入误差可能导致出现负数
     K *= -gamma
     np.exp(K, K)  # <==> K = np.exp(K)
     return K
 
 
+def symmetric_kernel(X, gamma, X_norm_squared, block_size=512):
+    # K(X, X)为对称矩阵：按行分块，每块只计算对角线及其右侧的部分，再转置拷贝到下三角，
+    # 矩阵乘法和exp的计算量都减少约一半
+    n_samples = X.shape[0]
+    K = np.empty((n_samples, n_samples), dtype=np.result_type(X.dtype, np.float32))
+    for start in range(0, n_samples, block_size):
+        stop = min(start + block_size, n_samples)
+        block = K[start:stop, start:]
+        np.matmul(X[start:stop], X[start:].T, out=block)
+        block *= -2
+        block += X_norm_squared[start:stop, None]
+        block += X_norm_squared[None, start:]
+        np.maximum(block, 0, out=block)  # 舍入误差可能导致出现负数
+        np.fill_diagonal(block, 0)  # block的对角线即K的对角线
+        block *= -gamma
+        np.exp(block, block)
+        for i in range(1, stop - start):  # 使对角块严格对称
+            block[i, :i] = block[:i, i]
+        K[stop:, start:stop] = block[:, stop - start:].T
+    return K
+
+
+def degree_inv_sqrt(degree):
+    # 计算D^{-1/2}的对角线元素，孤立样本（度为0）对应的元素置为0
+    d_inv_sqrt = np.zeros_like(degree)
+    np.sqrt(degree, out=d_inv_sqrt, where=degree > 0)
+    np.divide(1., d_inv_sqrt, out=d_inv_sqrt, where=degree > 0)
+    return d_inv_sqrt
+
+
+def spread_step(graph_matrix, F, y_static, alpha, out):
+    # 计算 out = alpha*S*F + (1-alpha)*Y，结果直接写入out中，不产生额外的中间矩阵
+    # 注意out不能与F为同一个数组
+    if isinstance(graph_matrix, np.ndarray):
+        # 计算 out^T = alpha*F^T*S^T + out^T，转置后均为Fortran连续的视图，
+        # 因此gemm(sgemm/dgemm)可以直接把结果写入out，缩放和相加也都在gemm中完成
+        out[...] = y_static
+        gemm = get_blas_funcs('gemm', (graph_matrix, F))
+        result = gemm(alpha, F.T, graph_matrix.T, beta=1.0, c=out.T, overwrite_c=1)
+        if not np.shares_memory(result, out):
+            # out的精度与gemm不一致时BLAS只能写入out的副本，需要再拷贝回out
+            out[...] = result.T
+    else:
+        out[...] = graph_matrix @ F  # 稀疏矩阵
+        out *= alpha
+        out += y_static
+    return out
+
+
+def spread_loop(graph_matrix, F, y_static, alpha, tol, max_iter):
+    # 迭代 F = alpha*S*F + (1-alpha)*Y 直到收敛，返回(F, 迭代次数, 是否收敛)
+    # F_prev和F_next两个缓冲区交替存放上一轮和这一轮的结果，每轮计算完成后再判断是否收敛
+    F_prev, F_next = F, np.empty_like(F)
+    diff = np.empty_like(F)  # 收敛判断所用的缓冲区，避免每轮分配临时矩阵
+    for n_iter in range(1, max_iter + 1):
+        spread_step(graph_matrix, F_prev, y_static, alpha, out=F_next)
+        np.subtract(F_next, F_prev, out=diff)
+        F_prev, F_next = F_next, F_prev
+        if np.abs(diff, out=diff).sum() < tol:
+            return F_prev, n_iter, True
+    return F_prev, max_iter, False
+
+
 class LabelSpreading():
     """Base class for label propagation module.
     """
 
-    def __init__(self, gamma=20, alpha=0.2,
-                 max_iter=30, tol=1e-3):
+    def __init__(self, kernel='knn', gamma=20, n_neighbors=7, alpha=0.2,
+                 max_iter=30, tol=1e-3, solver='iterative', dtype=np.float64):
+        self.kernel = kernel  # 'knn': 稀疏的K近邻图；'rbf': 稠密的全连接图
+        self.dtype = dtype  # 计算精度，np.float32可使内存占用和访存量减半，但gamma较大时权重容易下溢为0
+        self.n_neighbors = n_neighbors
         self.max_iter = max_iter
         self.tol = tol
         self.gamma = gamma
         self.alpha = alpha
+        self.solver = solver  # 'iterative': 迭代求解；'direct': 直接求解线性方程组（精确解，适合样本量不大或稀疏图）
 
-    def _get_kernel(self, X, y=None):
-        return kernel(X, y, gamma=self.gamma)
+    def _get_kernel(self, X, y=None, X_norm_squared=None, y_norm_squared=None):
+        return kernel(X, y, gamma=self.gamma, X_norm_squared=X_norm_squared,
+                      y_norm_squared=y_norm_squared, dtype=self.dtype)
+
+    def _get_knn_graph(self, X):
+        # 只保留每个样本最近的n_neighbors个邻居，以(行, 列, 权重)三元组的形式返回对称化后的稀疏W
+        n_samples = X.shape[0]
+        self.nn_fit = NearestNeighbors(n_neighbors=self.n_neighbors).fit(X)  # 预测时复用
+        distances, indices = self.nn_fit.kneighbors()  # 不把样本自身当作邻居
+        rows = np.repeat(np.arange(n_samples), self.n_neighbors)
+        cols = indices.ravel()
+        weights = np.exp(-self.gamma * distances.ravel().astype(self.dtype) ** 2)
+        # 对称化：i是j的近邻或j是i的近邻时都保留边(i, j)和(j, i)
+        # 先按无序对(min, max)去掉重复的边，再镜像得到另一半，保证W严格对称
+        lo, hi = np.minimum(rows, cols), np.maximum(rows, cols)
+        _, edges = np.unique(lo * n_samples + hi, return_index=True)
+        edges = edges[weights[edges] > 0]  # 去掉下溢为0的权重
+        lo, hi, weights = lo[edges], hi[edges], weights[edges]
+        return np.concatenate([lo, hi]), np.concatenate([hi, lo]), np.concatenate([weights, weights])
+
+    def _check_degree(self, degree):
+        # gamma较大（尤其是使用np.float32）时权重会下溢为0，大部分样本成为孤立点，标签无法传播
+        isolated = np.mean(degree == 0)
+        if isolated > 0.5:
+            logging.warning(f"{isolated:.0%}的样本与其它样本之间的权重全部为0"
+                            f"(dtype={np.dtype(self.dtype).name}, gamma={self.gamma})，"
+                            f"标签无法在图上传播，请减小gamma或使用np.float64")
 
     def _build_graph(self):
         # 计算标准化后的拉普拉斯矩阵
-        n_samples = self.X_.shape[0]
-        affinity_matrix = self._get_kernel(self.X_)
-        # D^{-1/2}WD^{-1/2}
-        laplacian = -csgraph.laplacian(affinity_matrix, normed=True)
-        laplacian.flat[::n_samples + 1] = 0.0  # 设置对角线原始全为0
-        return laplacian
+        if self.kernel == 'knn':
+            n_samples = self.X_.shape[0]
+            rows, cols, weights = self._get_knn_graph(self.X_)  # 不含对角线元素
+            degree = np.bincount(rows, weights=weights, minlength=n_samples)
+            self._check_degree(degree)
+            d_inv_sqrt = degree_inv_sqrt(degree.astype(self.dtype))
+            # 直接在三元组上计算 D^{-1/2}WD^{-1/2} 的非零元素，再一次性构造出CSR矩阵
+            weights *= d_inv_sqrt[rows]
+            weights *= d_inv_sqrt[cols]
+            return coo_matrix((weights, (rows, cols)), shape=(n_samples, n_samples)).tocsr()
+        if self.kernel != 'rbf':
+            raise ValueError(f"kernel只能为'knn'或'rbf'，当前为{self.kernel}")
+        affinity_matrix = self._get_kernel(self.X_, X_norm_squared=self._X_sqnorms_)
+        np.fill_diagonal(affinity_matrix, 0.)  # 设置对角线原始全为0
+        degree = affinity_matrix.sum(axis=1)
+        self._check_degree(degree)
+        d_inv_sqrt = degree_inv_sqrt(degree)
+        # 原地计算 D^{-1/2}WD^{-1/2}，不需要构造对角矩阵D以及D-W
+        affinity_matrix *= d_inv_sqrt[:, None]
+        affinity_matrix *= d_inv_sqrt[None, :]
+        return affinity_matrix
+
+    def _solve(self, y_static):
+        # 迭代 F = alpha*S*F + (1-alpha)*Y 的收敛解即为方程 (I - alpha*S)F = (1-alpha)*Y 的解，这里直接精确求解
+        # I - alpha*S 对称正定：稠密图用Cholesky分解，稀疏图用稀疏LU分解，所有类别一次解出
+        n_samples = y_static.shape[0]
+        if isinstance(self.graph_matrix, np.ndarray):
+            A = self.graph_matrix * -self.alpha
+            A.flat[::n_samples + 1] += 1
+            return solve(A, y_static, assume_a='pos', overwrite_a=True)
+        A = identity(n_samples, dtype=y_static.dtype, format='csc') - self.alpha * self.graph_matrix
+        return splu(A.tocsc()).solve(y_static)
+
+    def _iterate(self, y_static):
+        self.label_distributions_, self.n_iter_, converged = spread_loop(
+            self.graph_matrix, self.label_distributions_, y_static,
+            self.alpha, self.tol, self.max_iter)
+        if not converged:
+            logging.warning(
+                'max_iter=%d was reached without convergence.' % self.max_iter)
 
     def fit(self, X, y):
         """
@@ -51,7 +196,11 @@ class LabelSpreading():
             `n_labeled_samples` (unlabeled points are marked as -1)
             All unlabeled samples will be transductively assigned labels.
         """
-        self.X_ = X
+        if self.solver not in ('iterative', 'direct'):
+            raise ValueError(f"solver只能为'iterative'或'direct'，当前为{self.solver}")
+        self.X_ = X = np.asarray(X, dtype=self.dtype)
+        y = np.asarray(y)
+        self._X_sqnorms_ = np.einsum('ij,ij->i', X, X)  # 缓存训练样本的平方范数，预测时复用
         self.graph_matrix = self._build_graph()
         classes = np.unique(y)
         self.classes_ = (classes[classes != -1])
@@ -61,25 +210,22 @@ class LabelSpreading():
         alpha = self.alpha
         if alpha is None or alpha <= 0.0 or alpha >= 1.0:
             raise ValueError("alpha必须大于0小于1")
-        self.label_distributions_ = np.zeros((n_samples, n_classes))
-        for label in self.classes_:
-            self.label_distributions_[y == label, self.classes_ == label] = 1
+        self.label_distributions_ = np.zeros((n_samples, n_classes), dtype=self.dtype)
+        # 有标签的样本在其类别对应的维度上置为1，classes_由np.unique得到，已经有序
+        labeled = np.nonzero(y != -1)[0]
+        self.label_distributions_[labeled, np.searchsorted(self.classes_, y[labeled])] = 1
 
         y_static = np.copy(self.label_distributions_)
         y_static *= 1 - alpha
-        l_previous = np.zeros((self.X_.shape[0], n_classes))
-
-        for self.n_iter_ in range(self.max_iter):
-            if np.abs(self.label_distributions_ - l_previous).sum() < self.tol:
-                break
-            l_previous = self.label_distributions_
-            label_distributions_ = np.matmul(self.graph_matrix, self.label_distributions_)
-            self.label_distributions_ = alpha * label_distributions_ + y_static
+        if self.solver == 'direct':
+            self.label_distributions_ = self._solve(y_static)
+            self.n_iter_ = 0  # 直接求解，没有进行迭代
         else:
-            logging.warning(
-                'max_iter=%d was reached without convergence.' % self.max_iter)
-            self.n_iter_ += 1
+            self._iterate(y_static)
 
+        # 图矩阵必须保持对称标准化D^{-1/2}WD^{-1/2}：这是标签传播模型本身的定义，
+        # _solve中的solve(..., assume_a='pos')（Cholesky分解）也依赖其对称正定，
+        # 不能改为按行归一化，因此求解得到的F的行和不为1，仍需在这里标准化一次
         normalizer = np.sum(self.label_distributions_, axis=1, keepdims=True)
         normalizer[normalizer == 0] = 1
         self.label_distributions_ /= normalizer
@@ -112,9 +258,15 @@ class LabelSpreading():
         -------
         probabilities : shape (n_samples, n_classes)
         """
-        weight_matrices = self._get_kernel(self.X_, X)
-        weight_matrices = weight_matrices.T
-        probabilities = np.matmul(weight_matrices, self.label_distributions_)
+        if self.kernel == 'knn':
+            # 与训练时的K近邻图保持一致：对每个样本在训练集中的n_neighbors个近邻的标签分布求和，
+            # 只需要[n_samples, n_neighbors]的近邻索引，不会生成稠密的权重矩阵
+            indices = self.nn_fit.kneighbors(X, return_distance=False)
+            probabilities = self.label_distributions_[indices].sum(axis=1)
+        else:
+            # 直接计算[n_samples, n_train_samples]形状的权重矩阵，不需要转置，矩阵乘法时也无需拷贝
+            weight_matrices = self._get_kernel(X, self.X_, y_norm_squared=self._X_sqnorms_)
+            probabilities = weight_matrices @ self.label_distributions_
         normalizer = np.sum(probabilities, axis=1, keepdims=True)
         normalizer[normalizer == 0] = 1  # 平滑处理
         probabilities /= normalizer